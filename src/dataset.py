@@ -1,16 +1,94 @@
 import os
 import cv2
+import hashlib
+import tempfile
 import numpy as np
+import torch
 from torch.utils.data import Dataset
+from torchvision import tv_tensors
 from PIL import Image
 from tqdm import tqdm
 from concurrent.futures import ProcessPoolExecutor
 from sklearn.model_selection import train_test_split
 
+# preload buffers opened once per worker process
+_worker_buffers = None
+
+def _shared_buffer_path(directory=None):
+    """Unique temporary .npy path in directory, by default RAM-backed where /dev/shm is available"""
+    if directory is None and os.path.isdir('/dev/shm'):
+        directory = '/dev/shm'
+    fd, path = tempfile.mkstemp(suffix='.npy', dir=directory)
+    os.close(fd)
+    return path
+
+def _reduced_read_flag(scale):
+    """Largest cv2.IMREAD_REDUCED_COLOR_* decode that stays at or above the target size"""
+    for factor, flag in ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2)):
+        if scale >= factor:
+            return flag
+    return cv2.IMREAD_COLOR
+
+def _channel_moments(buffer, channel_axis, chunk_size):
+    """Per-channel mean and std of a uint8 buffer scaled to [0, 1], reduced a chunk of samples at a time"""
+    axes = tuple(axis for axis in range(buffer.ndim) if axis != channel_axis)
+    total, total_sq = 0.0, 0.0
+    for start in range(0, len(buffer), chunk_size):
+        chunk = buffer[start:start + chunk_size].astype(np.float64) / 255
+        total = total + chunk.sum(axis=axes)
+        total_sq = total_sq + np.square(chunk).sum(axis=axes)
+    count = buffer.size // buffer.shape[channel_axis]
+    mean = total / count
+    std = np.sqrt(np.maximum(total_sq / count - mean ** 2, 0))
+    return mean.astype(np.float32), std.astype(np.float32)
+
+def _image_size(path):
+    """(height, width) read from the image header alone, EXIF-rotated like cv2.imread"""
+    with Image.open(path) as im:
+        width, height = im.size
+        if im.getexif().get(0x0112, 1) in (5, 6, 7, 8):
+            width, height = height, width
+    return height, width
+
+def _init_worker(rgb_path, spec_path):
+    global _worker_buffers
+    _worker_buffers = (np.load(rgb_path, mmap_mode='r+'), np.load(spec_path, mmap_mode='r+'))
+
+def _load_into_buffers(task):
+    """Decode one (idx, args) sample and write it straight into the shared preload buffers"""
+    rgb_buffer, spec_buffer = _worker_buffers
+    idx, args = task
+    rgb_buffer[idx], spec_buffer[idx] = PotatoDataset.process_image(args)
+
 class PotatoDataset(Dataset):
     
-    def __init__(self, rgb_dir, spectral_dir, transform=None, mode='train', align=False, split_ratio=0.8, random_seed=42):
-        """Multispectral Potato Detection and Classification Dataset"""
+    def __init__(self, rgb_dir, spectral_dir, transform=None, mode='train', align=False, split_ratio=0.8, random_seed=42, cache_dir=None, preload=True):
+        """Multispectral Potato Detection and Classification Dataset
+
+        Images are preloaded into two contiguous uint8 arrays, ``self.rgb`` (N, H, W, 3) and
+        ``self.spec`` (N, 4, H, W), and each sample is returned as an ``(rgb, spectral)`` pair of
+        (3, H, W) and (4, H, W) tensors. ``transform`` is called once per sample with both uint8
+        tensors, so it should be built from ``torchvision.transforms.v2`` to keep random
+        augmentations identical across the RGB image and the spectral bands.
+
+        With ``cache_dir`` set, the buffers are written there on the first run and memory-mapped
+        on later runs, skipping JPEG decoding entirely. Point it at /dev/shm for RAM-speed access.
+
+        With ``preload=False`` nothing is decoded upfront; each sample is decoded in ``__getitem__``
+        instead, which caps RAM and startup time and relies on DataLoader workers to overlap
+        decoding with training (see ``src.train.make_dataloader``).
+        """
+        if transform is not None:
+            if not callable(transform):
+                raise TypeError(f"transform must be callable, got {type(transform).__name__}")
+            module = type(transform).__module__
+            if module.startswith('torchvision.transforms.') and not module.startswith('torchvision.transforms.v2'):
+                # v1 transforms take one PIL image or float tensor, not several uint8 tensors
+                raise TypeError(
+                    f"transform must be a torchvision.transforms.v2 transform or a callable taking tensors, got v1 "
+                    f"{type(transform).__name__}; e.g. v2.Compose([v2.Resize((224, 224)), v2.ToDtype(torch.float32, scale=True)])"
+                )
+
         self.mode = mode
         self.transform = transform
         self.align = align
@@ -37,14 +115,20 @@ class PotatoDataset(Dataset):
             train_files = sorted(train_files)
             val_files = sorted(val_files)
 
-            # Filter spectral files to match RGB splits
-            train_spectral_files = {
-                channel: [f for f in spectral_files[channel] if os.path.splitext(f)[0] in {os.path.splitext(r)[0] for r in train_files}]
+            # Filter spectral files to match RGB splits using one basename index per channel
+            spectral_by_base = {
+                channel: {os.path.splitext(f)[0]: f for f in spectral_files[channel]}
                 for channel in self.channels
             }
+            train_bases = [os.path.splitext(r)[0] for r in train_files]
+            val_bases = [os.path.splitext(r)[0] for r in val_files]
+            train_spectral_files = {
+                channel: [by_base[b] for b in train_bases if b in by_base]
+                for channel, by_base in spectral_by_base.items()
+            }
             val_spectral_files = {
-                channel: [f for f in spectral_files[channel] if os.path.splitext(f)[0] in {os.path.splitext(r)[0] for r in val_files}]
-                for channel in self.channels
+                channel: [by_base[b] for b in val_bases if b in by_base]
+                for channel, by_base in spectral_by_base.items()
             }
 
             # Assign files based on mode
@@ -59,79 +143,187 @@ class PotatoDataset(Dataset):
 
             folder_set = 'Train_Images'
 
-        # Preload and align images using multiprocessing
-        args_list = [
-            (rgb_dir, spectral_dir, folder_set, rgb_name, idx, self.channels, self.spectral_files, self.align)
+        # Ensure the base names match, once for the whole split
+        for channel in self.channels:
+            spectral_names = self.spectral_files[channel]
+            for idx, rgb_name in enumerate(self.rgb_files):
+                spectral_file = spectral_names[idx] if idx < len(spectral_names) else None
+                if spectral_file is None or os.path.splitext(rgb_name)[0] != os.path.splitext(spectral_file)[0]:
+                    raise ValueError(
+                        f"Mismatch detected: RGB file '{rgb_name}' does not match spectral file '{spectral_file}' in channel '{channel}'"
+                    )
+
+        if not self.rgb_files:
+            # Empty split, there is nothing to probe or decode
+            self.rgb = np.empty((0, 0, 0, 3), dtype=np.uint8)
+            self.spec = np.empty((0, len(self.channels), 0, 0), dtype=np.uint8)
+        elif not preload:
+            # Decode lazily, one sample per __getitem__ call
+            self.rgb = self.spec = None
+            self._sample_args, _ = self._sample_args_list(rgb_dir, spectral_dir, folder_set)
+        elif cache_dir is None:
+            # Workers write into RAM-backed .npy buffers in place, so no arrays are pickled back
+            rgb_path, spec_path = _shared_buffer_path(), _shared_buffer_path()
+            try:
+                self._preload(rgb_dir, spectral_dir, folder_set, rgb_path, spec_path)
+            finally:
+                # the mappings stay valid after the files are unlinked
+                os.remove(rgb_path)
+                os.remove(spec_path)
+        else:
+            # Reuse buffers preloaded by an earlier run over the same files
+            # per-file mtimes and sizes invalidate the cache when any image is edited or replaced
+            input_paths = [os.path.join(rgb_dir, folder_set, rgb_name) for rgb_name in self.rgb_files] + [
+                os.path.join(spectral_dir, channel, folder_set, spectral_name)
+                for channel in self.channels for spectral_name in self.spectral_files[channel]
+            ]
+            input_stats = [(path, stat.st_mtime_ns, stat.st_size) for path, stat in zip(input_paths, map(os.stat, input_paths))]
+            key = hashlib.sha1(repr((rgb_dir, spectral_dir, folder_set, self.align, input_stats)).encode()).hexdigest()[:16]
+            rgb_path = os.path.join(cache_dir, f"{mode}_{key}_rgb.npy")
+            spec_path = os.path.join(cache_dir, f"{mode}_{key}_spec.npy")
+            if not (os.path.exists(rgb_path) and os.path.exists(spec_path)):
+                os.makedirs(cache_dir, exist_ok=True)
+                # unique temporary names, so concurrent builders never write into each other's files
+                rgb_tmp, spec_tmp = _shared_buffer_path(cache_dir), _shared_buffer_path(cache_dir)
+                try:
+                    self._preload(rgb_dir, spectral_dir, folder_set, rgb_tmp, spec_tmp)
+                    self.rgb.flush()
+                    self.spec.flush()
+                    os.replace(rgb_tmp, rgb_path)
+                    os.replace(spec_tmp, spec_path)
+                finally:
+                    for path in (rgb_tmp, spec_tmp):
+                        if os.path.exists(path):
+                            os.remove(path)
+
+            # copy-on-write keeps the arrays writable for torch.from_numpy without touching the cache
+            self.rgb = np.load(rgb_path, mmap_mode='c')
+            self.spec = np.load(spec_path, mmap_mode='c')
+
+    def _sample_args_list(self, rgb_dir, spectral_dir, folder_set):
+        """Build the process_image arguments for every sample, returns them with the spectral (height, width)"""
+        sample_paths = [
+            (
+                os.path.join(rgb_dir, folder_set, rgb_name),
+                [os.path.join(spectral_dir, channel, folder_set, self.spectral_files[channel][idx]) for channel in self.channels]
+            )
             for idx, rgb_name in enumerate(self.rgb_files)
         ]
 
-        with ProcessPoolExecutor() as executor:
-            results = list(tqdm(executor.map(self.process_image, args_list), desc=f"Loading {mode} data", total=len(self.rgb_files)))
+        # Spectral images share one resolution, probe it once for the whole dataset
+        height, width = _image_size(sample_paths[0][1][0])
+
+        # RGB frames are larger than the spectral ones, so let libjpeg skip most of the IDCT work
+        rgb_height, rgb_width = _image_size(sample_paths[0][0])
+        rgb_read_flag = _reduced_read_flag(min(rgb_height // height, rgb_width // width))
+
+        args_list = [
+            (rgb_path, spectral_paths, self.align, rgb_read_flag, (height, width))
+            for rgb_path, spectral_paths in sample_paths
+        ]
+        return args_list, (height, width)
+
+    def _preload(self, rgb_dir, spectral_dir, folder_set, rgb_path, spec_path):
+        """Decode every sample into .npy buffers at rgb_path / spec_path using multiprocessing"""
+        args_list, (height, width) = self._sample_args_list(rgb_dir, spectral_dir, folder_set)
+        num_images = len(args_list)
+
+        self.rgb = np.lib.format.open_memmap(rgb_path, mode='w+', dtype=np.uint8, shape=(num_images, height, width, 3))
+        self.spec = np.lib.format.open_memmap(spec_path, mode='w+', dtype=np.uint8, shape=(num_images, len(self.channels), height, width))
 
-        self.data = results
+        # Preload and align images using multiprocessing, handing each worker a contiguous run
+        # of the sorted files so its reads stay sequential per directory
+        chunksize = max(1, num_images // (4 * (os.cpu_count() or 1)))
+        with ProcessPoolExecutor(initializer=_init_worker, initargs=(rgb_path, spec_path)) as executor:
+            list(tqdm(executor.map(_load_into_buffers, enumerate(args_list), chunksize=chunksize), desc=f"Loading {self.mode} data", total=num_images))
+
+    def channel_stats(self, chunk_size=64):
+        """
+        Per-channel mean and std over the whole split, scaled to [0, 1] like v2.ToDtype(scale=True).
+        Returns:
+            (rgb_mean, rgb_std, spectral_mean, spectral_std) as float32 arrays of 3 and 4 values.
+        """
+        if self.rgb is None:
+            raise ValueError("channel_stats needs the preloaded buffers, create the dataset with preload=True")
+        if len(self.rgb) == 0:
+            raise ValueError(f"channel_stats needs at least one sample, the {self.mode} split is empty")
+        return (*_channel_moments(self.rgb, 3, chunk_size), *_channel_moments(self.spec, 1, chunk_size))
+
+    def __getstate__(self):
+        # Buffers backed by cache files travel as their path, so spawned DataLoader
+        # workers re-map them instead of unpickling a full copy of the dataset
+        state = self.__dict__.copy()
+        for name in ('rgb', 'spec'):
+            buffer = state[name]
+            if isinstance(buffer, np.memmap) and buffer.filename and os.path.exists(buffer.filename):
+                state[name] = buffer.filename
+        return state
+
+    def __setstate__(self, state):
+        for name in ('rgb', 'spec'):
+            if isinstance(state[name], str):
+                state[name] = np.load(state[name], mmap_mode='c')
+        self.__dict__.update(state)
 
     def __len__(self):
-        return len(self.data)
+        return len(self.rgb_files)
 
     def __getitem__(self, idx):
-        rgb_image, spectral_images = self.data[idx]
-
-        # Convert to PIL
-        rgb_image = Image.fromarray(rgb_image).convert('RGB')
-        spectral_images = [Image.fromarray(img) for img in spectral_images]
+        if self.rgb is None:
+            rgb_image, spectral_image = self.process_image(self._sample_args[idx])
+        else:
+            # Zero-copy views into the preload buffers
+            rgb_image, spectral_image = self.rgb[idx], self.spec[idx]
+        rgb_image = torch.from_numpy(rgb_image).permute(2, 0, 1)
+        spectral_image = torch.from_numpy(spectral_image)
 
-        # Apply transformations
+        # Apply transformations jointly so every band gets the same random parameters
         if self.transform:
-            rgb_image = self.transform(rgb_image)
-            spectral_images = [self.transform(img) for img in spectral_images]
+            rgb_image, spectral_image = self.transform(tv_tensors.Image(rgb_image), tv_tensors.Image(spectral_image))
 
-        return (rgb_image, *spectral_images)
+        return rgb_image, spectral_image
 
     @staticmethod
     def process_image(args):
         """
         Process a single image (alignment and resizing).
-        Ensures RGB and spectral images are correctly matched by comparing their base names.
+        Takes (rgb_path, spectral_paths, align, rgb_read_flag, (height, width)), file matching is
+        validated upfront in __init__.
         """
-        rgb_dir, spectral_dir, folder_set, rgb_name, idx, channels, spectral_files, align = args
-
-        # Read the RGB image
-        rgb_path = os.path.join(rgb_dir, folder_set, rgb_name)
-        rgb_im = cv2.imread(rgb_path)
-
-        # Ensure the base names match
-        for channel in channels:
-            spectral_file = spectral_files[channel][idx]
-            if os.path.splitext(rgb_name)[0] != os.path.splitext(spectral_file)[0]:
-                raise ValueError(
-                    f"Mismatch detected: RGB file '{rgb_name}' does not match spectral file '{spectral_file}' in channel '{channel}'"
-                )
+        rgb_path, spectral_paths, align, rgb_read_flag, (height, width) = args
+
+        # Read the RGB image, downscaled during decoding when rgb_read_flag is a reduced mode
+        rgb_im = cv2.imread(rgb_path, rgb_read_flag)
+        if rgb_im.shape[0] < height or rgb_im.shape[1] < width:
+            # A frame smaller than the probed one, decode it at full size so it is still downscaled
+            rgb_im = cv2.imread(rgb_path)
 
-        # Resize RGB to match spectral dimensions
-        height, width = cv2.imread(
-            os.path.join(spectral_dir, channels[0], folder_set, spectral_files[channels[0]][idx]),
-            cv2.IMREAD_GRAYSCALE
-        ).shape
+        # Resize RGB to match spectral dimensions, shared by the whole dataset
         rgb_resized = cv2.resize(rgb_im, (width, height), interpolation=cv2.INTER_LINEAR)
         rgb_gray = cv2.cvtColor(rgb_resized, cv2.COLOR_BGR2GRAY)
 
+        # Every band is aligned to the same RGB frame, so detect its features once
+        base_features = cv2.SIFT_create().detectAndCompute(rgb_gray, None) if align else None
+
         # Process spectral images
         spectral_images = []
-        for channel in channels:
-            spectral_path = os.path.join(spectral_dir, channel, folder_set, spectral_files[channel][idx])
+        for spectral_path in spectral_paths:
             spectral_im = cv2.imread(spectral_path, cv2.IMREAD_GRAYSCALE)
             if align:
-                aligned_image = PotatoDataset.align_images(rgb_gray, spectral_im)
+                aligned_image = PotatoDataset.align_images(rgb_gray, spectral_im, base_features)
                 spectral_images.append(aligned_image)
             else:
                 spectral_images.append(spectral_im)
 
         # Validate size consistency
-        for channel, spectral_im in zip(channels, spectral_images):
+        for spectral_path, spectral_im in zip(spectral_paths, spectral_images):
             assert spectral_im.shape == rgb_resized.shape[:2], \
-                f"Size mismatch: RGB {rgb_resized.shape[:2]} vs {channel} {spectral_im.shape}"
+                f"Size mismatch: RGB {rgb_resized.shape[:2]} vs {spectral_path} {spectral_im.shape}"
+
+        # OpenCV decodes BGR, convert once here so the buffers hold true RGB
+        rgb_resized = cv2.cvtColor(rgb_resized, cv2.COLOR_BGR2RGB)
 
-        return (rgb_resized, spectral_images)
+        return (rgb_resized, np.stack(spectral_images))
     """
     @staticmethod
     def align_images(base_img, img_to_align):
@@ -153,10 +345,10 @@ class PotatoDataset(Dataset):
         aligned_img = cv2.warpPerspective(img_to_align, h, (base_img.shape[1], base_img.shape[0]))
         return aligned_img
     """
-    def align_images(base_img, img_to_align): 
+    def align_images(base_img, img_to_align, base_features=None): 
         sift = cv2.SIFT_create()
         kp1, des1 = sift.detectAndCompute(img_to_align, None)
-        kp2, des2 = sift.detectAndCompute(base_img, None)
+        kp2, des2 = base_features if base_features is not None else sift.detectAndCompute(base_img, None)
 
         matcher = cv2.FlannBasedMatcher()
         matches = matcher.knnMatch(des1, des2, k=2)
@@ -172,6 +364,6 @@ class PotatoDataset(Dataset):
         dst_pts = np.float32([kp2[m.trainIdx].pt for m in good]).reshape(-1, 1, 2)
         H, _ = cv2.findHomography(src_pts, dst_pts, cv2.RANSAC, 5.0)
 
-        # Warp image
-        aligned_img = cv2.warpPerspective(img_to_align, H, (base_img.shape[1], base_img.shape[0]))
+        # Warp image (OpenCV's SIMD warp path)
+        aligned_img = cv2.warpPerspective(img_to_align, H, (base_img.shape[1], base_img.shape[0]), flags=cv2.INTER_LINEAR)
         return aligned_img
@@ -1,25 +1,45 @@
+import copy
 import math
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.ao.nn.intrinsic as nni
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
 
 class DoubleConv(nn.Module):
     
     def __init__(self, in_channels, out_channels):
         super().__init__()
         
-        # two convolutions with 3x3 kernel
+        # two convolutions with 3x3 kernel, bias is redundant ahead of batch norm
+        # intrinsic Conv+BN+ReLU blocks mark the fusable pattern for quantization and inductor
         self.conv_op = nn.Sequential(
-            nn.Conv2d(in_channels, out_channels, kernel_size=3, padding=1),
-            nn.ReLU(inplace=True),
-            nn.Conv2d(out_channels, out_channels, kernel_size=3, padding=1),
-            nn.ReLU(inplace=True)
+            nni.ConvBnReLU2d(
+                nn.Conv2d(in_channels, out_channels, kernel_size=3, padding=1, bias=False),
+                nn.BatchNorm2d(out_channels),
+                nn.ReLU()
+            ),
+            nni.ConvBnReLU2d(
+                nn.Conv2d(out_channels, out_channels, kernel_size=3, padding=1, bias=False),
+                nn.BatchNorm2d(out_channels),
+                nn.ReLU()
+            )
         )
     
     def forward(self, x):
         
         return self.conv_op(x)
     
+    def fuse(self):
+        """Fold each BatchNorm2d into the preceding Conv2d (eval mode only)"""
+        for idx, block in enumerate(self.conv_op):
+            if isinstance(block, nni.ConvBnReLU2d):
+                conv, bn, relu = block
+                self.conv_op[idx] = nni.ConvReLU2d(fuse_conv_bn_eval(conv, bn), relu)
+        return self
+    
 class Downsample(nn.Module):
     
     def __init__(self, in_channels, out_channels):
@@ -37,19 +57,19 @@ class Downsample(nn.Module):
 class Upsample(nn.Module):
     def __init__(self, in_channels, out_channels):
         super().__init__()
-        self.up = nn.ConvTranspose2d(in_channels, in_channels // 2, kernel_size=2, stride=2)
-        self.double_conv = DoubleConv(in_channels, out_channels)
-        self.double_conv_half = DoubleConv(in_channels // 2, out_channels)
+        # 1x1 conv + nearest upsample, cheaper than a transposed conv and free of checkerboard artifacts;
+        # the pointwise conv commutes with nearest upsampling, so it runs at the input resolution
+        self.up = nn.Sequential(
+            nn.Conv2d(in_channels, out_channels, kernel_size=1),
+            nn.Upsample(scale_factor=2, mode='nearest')
+        )
+        self.double_conv = DoubleConv(out_channels, out_channels)
 
     def forward(self, x1, x2=None):
-        x1 = self.up(x1)
+        x = self.up(x1)
         if x2 is not None:
-            x = torch.cat([x1, x2], dim=1)
-            x = self.double_conv(x)
-        else:
-            x = x1  # No skip connection
-            x = self.double_conv_half(x)
-        return x
+            x = x + x2  # additive skip, the skip has out_channels channels
+        return self.double_conv(x)
     
 class TransformerBlock(nn.Module):
     
@@ -228,6 +248,70 @@ class UNet(nn.Module):
         # output layer
         out = self.out(up_4)
         return out
+
+def compile_unet(model, mode="max-autotune-no-cudagraphs", backend="inductor"):
+    """Compile a model with TorchInductor so Conv2d + ReLU pairs and the decoder's skip-add + conv
+    tails run as fused kernels, saving HBM round-trips of the full-resolution feature maps.
+
+    The model is captured as one graph so fusion can cross module boundaries (such as the
+    bottleneck output feeding the first Upsample). The default mode autotunes kernels without
+    Inductor's own CUDA graphs, so it composes with CUDAGraphTrainStep.
+    """
+    return torch.compile(model, mode=mode, backend=backend, fullgraph=True)
+
+def fuse_conv_bn(model):
+    """Fold the BatchNorm2d layers of every DoubleConv into their convolutions for inference.
+
+    W = gamma / sqrt(var + eps) * W and b = gamma / sqrt(var + eps) * (b - mean) + beta, so the
+    fused model gives the same outputs with the BN ops gone from the graph and each block left
+    as a ConvReLU2d, which eager int8 quantization converts into a single fused kernel.
+    """
+    model.eval()
+    for module in model.modules():
+        if isinstance(module, DoubleConv):
+            module.fuse()
+    return model
+
+def quantize_unet(model, calibration_inputs, backend="x86"):
+    """Post-training int8 quantization of a trained model for CPU inference.
+
+    Activations are quantized per-tensor. On "x86" the weights are quantized per-channel
+    symmetric, so the convs run on the int8 (VNNI) kernels; "qnnpack" uses per-tensor weights.
+    The model is quantized from a CPU copy, as the int8 kernels only exist on the CPU,
+    so the input model (and its device) is left untouched. Running the returned model needs
+    torch.backends.quantized.engine set to the same backend; it is only switched while
+    calibrating and converting, then restored.
+
+    Args:
+        model: Trained float model, on any device.
+        calibration_inputs: Iterable of input batches used to observe activation ranges.
+        backend: Quantized engine to target, "x86" (fbgemm + onednn) or "qnnpack" for ARM.
+    """
+    calibration_inputs = (x.cpu() for x in calibration_inputs)
+    example_input = next(calibration_inputs, None)
+    if example_input is None:
+        raise ValueError("quantize_unet needs at least one calibration batch")
+
+    previous_engine = torch.backends.quantized.engine
+    torch.backends.quantized.engine = backend
+    try:
+        model = fuse_conv_bn(copy.deepcopy(model).cpu())
+        prepared = prepare_fx(model, get_default_qconfig_mapping(backend), example_inputs=(example_input,))
+        with torch.no_grad():
+            prepared(example_input)
+            for x in calibration_inputs:
+                prepared(x)
+        return convert_fx(prepared)
+    finally:
+        torch.backends.quantized.engine = previous_engine
+
+def freeze_unet(model):
+    """Script and freeze a trained model for inference.
+
+    Freezing inlines the weights as constants, which is what lets the JIT fold
+    Conv2d + ReLU (and Conv2d + add) into single fused ops.
+    """
+    return torch.jit.optimize_for_inference(torch.jit.script(model.eval()))
     
 ##############################################
 ################ VAE SETUP ###################
@@ -271,8 +355,8 @@ class VAE(nn.Module):
         _, p3 = self.down_conv_3(p2)
         _, p4 = self.down_conv_4(p3)
 
-        # flatten
-        p4 = p4.view(p4.size(0), -1)
+        # flatten, reshape rather than view so channels-last inputs work too
+        p4 = p4.flatten(1)
         mu = self.bottleneck_mu(p4)
         logvar = self.bottleneck_logvar(p4)
         return mu, logvar
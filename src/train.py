@@ -0,0 +1,181 @@
+import os
+import torch
+from torch.utils.data import DataLoader
+from torchvision import tv_tensors
+from tqdm import tqdm
+
+def configure_backends():
+    """
+    Lets cuDNN benchmark and cache the fastest algorithm for each conv shape, and allows TF32
+    for convs and matmuls (also the precision torch.compile lowers FP32 matmuls to).
+    Call once at program start, it pays off when input shapes stay fixed across steps.
+    """
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.set_float32_matmul_precision('high')
+
+def make_dataloader(dataset, batch_size, shuffle=False, num_workers=None, prefetch_factor=4, drop_last=False):
+    """
+    Builds a DataLoader whose workers prefetch and decode batches while the GPU trains.
+    Args:
+        dataset: Dataset to load, typically a PotatoDataset built with preload=False.
+        batch_size: Samples per batch.
+        shuffle: Whether to reshuffle every epoch.
+        num_workers: Worker processes, defaults to half the CPU cores.
+        prefetch_factor: Batches each worker keeps in flight.
+        drop_last: Drop the final partial batch, use for training so every step sees the same
+            shape and cuDNN / torch.compile never re-tune for a one-off batch size.
+    """
+    if num_workers is None:
+        num_workers = max(1, (os.cpu_count() or 2) // 2)
+    return DataLoader(
+        dataset,
+        batch_size=batch_size,
+        shuffle=shuffle,
+        num_workers=num_workers,
+        pin_memory=torch.cuda.is_available(),  # page-locked batches allow async host-to-device copies
+        persistent_workers=num_workers > 0,
+        prefetch_factor=prefetch_factor if num_workers > 0 else None,
+        drop_last=drop_last
+    )
+
+def prepare_batch(batch, device, batch_transform=None):
+    """
+    Moves an (rgb, spectral) batch to the device and runs batch_transform on it there.
+    Args:
+        batch: (rgb, spectral) batch from the DataLoader.
+        device: Device (CPU/GPU) to use.
+        batch_transform: Optional torchvision.transforms.v2 transform applied jointly to the
+            (B, C, H, W) RGB and spectral batches, e.g. resize + ToDtype. Leaving the dataset
+            transform unset ships uint8 batches, a quarter of the host-to-device traffic of float32.
+            Random transforms draw one set of parameters per batch, not per sample.
+    Returns:
+        Channels-last RGB inputs and spectral targets on the device.
+    """
+    rgb_images, spectral_images = batch
+    rgb_images = rgb_images.to(device, non_blocking=True)
+    spectral_images = spectral_images.to(device, non_blocking=True)
+    if batch_transform is not None:
+        rgb_images, spectral_images = batch_transform(tv_tensors.Image(rgb_images), tv_tensors.Image(spectral_images))
+        rgb_images, spectral_images = rgb_images.as_subclass(torch.Tensor), spectral_images.as_subclass(torch.Tensor)
+    return rgb_images.contiguous(memory_format=torch.channels_last), spectral_images
+
+def to_channels_last(model):
+    """
+    Move a model to NHWC so cuDNN can dispatch its TensorCore conv kernels.
+    Pair with compile_unet rather than freeze_unet, the TorchScript fuser handles NHWC poorly.
+    """
+    return model.to(memory_format=torch.channels_last)
+
+class CUDAGraphTrainStep:
+    """
+    Captures a whole fixed-shape training step (forward, loss, backward and optimizer step) as
+    one CUDA graph, so each step is a single graph replay instead of dozens of kernel launches.
+    The model is put in train mode before capture, so replays always run in train mode (BatchNorm
+    keeps updating its running statistics) whatever mode the model is switched to later.
+    Args:
+        model: Model to train, already on the GPU (ideally channels-last).
+        criterion: Loss function.
+        optimizer: Optimizer built with capturable=True (e.g. Adam(..., capturable=True)).
+        sample_input: Input batch with the shape every later batch will have.
+        sample_target: Target batch matching sample_input.
+        amp_dtype: Autocast dtype, torch.bfloat16 or None. FP16 is not supported because
+            GradScaler's inf checks synchronise with the host and cannot be captured.
+        warmup_steps: Eager steps run on a side stream before capture, these update the model.
+    """
+
+    def __init__(self, model, criterion, optimizer, sample_input, sample_target, amp_dtype=torch.bfloat16, warmup_steps=3):
+        if amp_dtype == torch.float16:
+            raise ValueError("CUDA graph capture does not support FP16 loss scaling, use torch.bfloat16 or None")
+
+        self.model = model
+        self.criterion = criterion
+        self.optimizer = optimizer
+        self.amp_dtype = amp_dtype
+
+        # Replays always read from and write to these same tensors
+        self.static_input = sample_input.detach().clone().contiguous(memory_format=torch.channels_last)
+        self.static_target = sample_target.detach().clone()
+
+        # The captured kernels fix the mode, so capture the training-mode graph
+        self.model.train()
+
+        # Warm up on a side stream so lazy allocations happen before capture
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(warmup_steps):
+                self.optimizer.zero_grad(set_to_none=True)
+                self._forward_backward()
+                self.optimizer.step()
+        torch.cuda.current_stream().wait_stream(stream)
+
+        # Capture one step, gradients are overwritten in place on every replay
+        self.graph = torch.cuda.CUDAGraph()
+        self.optimizer.zero_grad(set_to_none=True)
+        with torch.cuda.graph(self.graph):
+            self.static_loss = self._forward_backward()
+            self.optimizer.step()
+
+    def _forward_backward(self):
+        with torch.autocast('cuda', dtype=self.amp_dtype, enabled=self.amp_dtype is not None):
+            outputs = self.model(self.static_input)
+            loss = self.criterion(outputs.float(), self.static_target)
+        loss.backward()
+        return loss
+
+    def __call__(self, inputs, targets):
+        """Runs one captured step on a batch, returns the (static) loss tensor"""
+        self.static_input.copy_(inputs, non_blocking=True)
+        self.static_target.copy_(targets, non_blocking=True)
+        self.graph.replay()
+        return self.static_loss
+
+def train_one_epoch(model, dataloader, criterion, optimizer, device, amp_dtype=torch.bfloat16, desc="Training", graph_step=None, batch_transform=None):
+    """
+    Runs one training epoch with channels-last inputs under autocast.
+    Args:
+        model: Model to train, ideally already passed through to_channels_last.
+        dataloader: DataLoader yielding (rgb, spectral) batches.
+        criterion: Loss function.
+        optimizer: Optimizer for the model parameters.
+        device: Device (CPU/GPU) to use.
+        amp_dtype: Autocast dtype (torch.bfloat16 or torch.float16), None to train in FP32.
+        desc: Progress bar description.
+        graph_step: Optional CUDAGraphTrainStep, replaces the eager step. Use with a loader built
+            with drop_last=True so every batch matches the captured shape.
+        batch_transform: Optional on-device transform, see prepare_batch.
+    Returns:
+        Mean training loss over the epoch.
+    """
+    device = torch.device(device)
+    model.train()
+
+    # FP16 needs loss scaling to keep small gradients from underflowing, BF16 does not
+    scaler = torch.amp.GradScaler(device.type, enabled=amp_dtype == torch.float16)
+
+    train_loss = 0.0
+    train_loop = tqdm(dataloader, desc=desc, leave=False)
+    for batch in train_loop:
+        rgb_images, spectral_images = prepare_batch(batch, device, batch_transform)  # Inputs and target spectral channels
+
+        if graph_step is not None:
+            loss = graph_step(rgb_images, spectral_images)
+        else:
+            # Forward pass
+            optimizer.zero_grad()
+            with torch.autocast(device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+                outputs = model(rgb_images)
+                loss = criterion(outputs.float(), spectral_images)
+
+            # Backward pass
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+
+        # Update progress
+        train_loss += loss.item()
+        train_loop.set_postfix(loss=loss.item())
+
+    return train_loss / len(dataloader)
@@ -1,7 +1,7 @@
-import torch
 import matplotlib.pyplot as plt
+from src.train import prepare_batch
 
-def show_predictions(dataloader, model, device, channels=None):
+def show_predictions(dataloader, model, device, channels=None, batch_transform=None):
     """
     Displays the RGB input, ground truth spectral channels, and model predictions for a single sample in a vertical layout.
     Args:
@@ -9,6 +9,7 @@ def show_predictions(dataloader, model, device, channels=None):
         model: Trained model to generate predictions.
         device: Device (CPU/GPU) to use.
         channels: List of channel names (e.g., ['Green', 'NIR', 'Red', 'Red Edge']).
+        batch_transform: Optional on-device transform, as passed to train_one_epoch.
     """
     model.eval()  # Set model to evaluation mode
 
@@ -16,9 +17,7 @@ def show_predictions(dataloader, model, device, channels=None):
     num_spectral_channels = len(channels)
 
     # Get one batch of data
-    rgb_images, *spectral_images = next(iter(dataloader))
-    rgb_images = rgb_images.to(device)  # Move RGB inputs to the device
-    spectral_images = torch.stack(spectral_images, dim=1).squeeze(2).to(device)  # Ground truth
+    rgb_images, spectral_images = prepare_batch(next(iter(dataloader)), device, batch_transform)  # Inputs and ground truth
     predictions = model(rgb_images)  # Model predictions
 
     # Use only the first sample in the batch